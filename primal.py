@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python
 # Primal scheme by Josh Quick and Andy Smith 2016
 # www.github.com/aresti/primalrefactor.git
 
@@ -16,7 +16,8 @@ from primal.models import MultiplexScheme
 
 def multiplex(args):
     scheme = MultiplexScheme(args.references, args.amplicon_length, min_overlap=args.min_overlap, max_gap=args.max_gap,
-                             search_space=args.search_space, max_candidates=args.max_candidates, prefix=args.prefix)
+                             search_space=args.search_space, max_candidates=args.max_candidates, prefix=args.prefix,
+                             processes=args.processes, cache_dir=args.cache_dir)
     scheme.write_bed(args.output_path)
     scheme.write_pickle(args.output_path)
     scheme.write_tsv(args.output_path)
@@ -38,6 +39,8 @@ def main():
     parser_scheme.add_argument('--max-gap', help='Maximum gap to introduce before failing', type=int, default=100)
     parser_scheme.add_argument('--max-candidates', help='Maximum candidate primers', type=int, default=10)
     parser_scheme.add_argument('--search-space', help='Initial primer search space', type=int, default=40)
+    parser_scheme.add_argument('--processes', help='Worker processes for primer alignment', type=int, default=1)
+    parser_scheme.add_argument('--cache-dir', help='Directory to cache Primer3 results between runs', default=None)
     parser_scheme.add_argument('--output-path', help='Output directory to save files', default='./')
     parser_scheme.add_argument('--force', help='Force overwrite', action="store_true")
     parser_scheme.add_argument('--debug', help='Verbose logging', action="store_true")
@@ -73,8 +76,9 @@ def main():
     logger.addHandler(sh)
 
     logger.info('Primal scheme started...)')
-    for arg in vars(args):
-        logger.debug('{}: {}'.format(arg, str(vars(args)[arg])))
+    if logger.isEnabledFor(logging.DEBUG):
+        for arg in vars(args):
+            logger.debug('{}: {}'.format(arg, str(vars(args)[arg])))
 
     for r in args.references:
         logger.info('Reference: {}'.format(r.id))
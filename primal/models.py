@@ -1,24 +1,50 @@
+import errno
+import hashlib
 import logging
+import multiprocessing
 import os
+import parasail
 import pickle
 import primer3
-import re
-import settings
+import tempfile
 
-from Bio import pairwise2, Seq, SeqIO
+from Bio import SeqIO
 from Bio.Graphics import GenomeDiagram
 from Bio.SeqFeature import FeatureLocation, SeqFeature
 from reportlab.lib import colors
 
-from exceptions import NoSuitableException
+from . import settings
+from .exceptions import NoSuitableException
+
+try:
+    from string import maketrans
+except ImportError:
+    maketrans = str.maketrans
 
 
 logger = logging.getLogger('Primal Log')
 
+# Scoring for semi-global primer alignment; gap penalties are positive in parasail
+MATCH = 2
+MISMATCH = -1
+# Every IUPAC code is in the matrix so ambiguous reference bases score as mismatches, not 0 as unknown letters do
+MATRIX = parasail.matrix_create('ACGTRYSWKMBDHVN', MATCH, MISMATCH)
+GAP_OPEN = 2
+GAP_EXTEND = 1
+
+# IUPAC complement translation table, applied directly to plain strings
+COMPLEMENT = maketrans('ACGTRYSWKMBDHVN', 'TGCAYRSWMKVHDBN')
+
+# (primer base, reference base) pairs treated as a 3' mismatch, with the reference complement folded in
+MISMATCHES_3PRIME = frozenset((q, r) for q in 'ACGT' for r in 'ACGT'
+                              if frozenset([q, r.translate(COMPLEMENT)]) in settings.MISMATCHES)
+
 
 class Primer(object):
     """A simple primer."""
 
+    __slots__ = ('direction', 'name', 'seq')
+
     def __init__(self, direction, name, seq):
         # TODO: Validate direction is LEFT or RIGHT
         self.direction = direction
@@ -33,7 +59,9 @@ class Primer(object):
 class CandidatePrimer(Primer):
     """A candidate primer for a region."""
 
-    def __init__(self, direction, name, seq, start, gc, tm, references):
+    __slots__ = ('start', 'gc', 'tm', 'sub_total', 'alignments')
+
+    def __init__(self, direction, name, seq, start, gc, tm):
         super(CandidatePrimer, self).__init__(direction, name, seq)
         self.start = start
         self.gc = gc
@@ -42,11 +70,6 @@ class CandidatePrimer(Primer):
         self.sub_total = 0
         self.alignments = []
 
-        for ref in references:
-            alignment = Alignment(self, ref)
-            self.alignments.append(alignment)
-            self.sub_total += alignment.score
-
     @property
     def end(self):
         if self.direction == 'LEFT':
@@ -58,6 +81,8 @@ class CandidatePrimer(Primer):
 class CandidatePrimerPair(object):
     """A pair of candidate primers for a region."""
 
+    __slots__ = ('left', 'right', 'total')
+
     def __init__(self, left, right):
         self.left = left
         self.right = right
@@ -71,34 +96,37 @@ class CandidatePrimerPair(object):
 class Region(object):
     """A region that forms part of a scheme."""
 
-    def __init__(self, prefix, region_num, max_candidates, start_limits, primer3_output, references):
+    def __init__(self, prefix, region_num, primer3_keys, start_limits, primer3_output, ref_seqs, worker_pool=None):
         self.region_num = region_num
         self.pool = '2' if self.region_num % 2 == 0 else '1'
-        self.candidate_pairs = []
-
-        for cand_num in range(max_candidates):
-            lenkey = 'PRIMER_LEFT_%s' % (cand_num)
-            left_name = '%s_%i_%s' % (prefix, region_num, 'LEFT')
-            right_name = '%s_%i_%s' % (prefix, region_num, 'RIGHT')
-            if lenkey not in primer3_output:
-                break
-
-            left_seq = str(primer3_output['PRIMER_LEFT_%i_SEQUENCE' % (cand_num)])
-            right_seq = str(primer3_output['PRIMER_RIGHT_%i_SEQUENCE' % (cand_num)])
-
-            left_start = int(primer3_output['PRIMER_LEFT_%i' % (cand_num)][0] + start_limits[0])
-            right_start = int(primer3_output['PRIMER_RIGHT_%i' % (cand_num)][0] + start_limits[0] + 1)
-
-            left_gc = float(primer3_output['PRIMER_LEFT_%i_GC_PERCENT' % (cand_num)])
-            right_gc = float(primer3_output['PRIMER_RIGHT_%i_GC_PERCENT' % (cand_num)])
-
-            left_tm = float(primer3_output['PRIMER_LEFT_%i_TM' % (cand_num)])
-            right_tm = float(primer3_output['PRIMER_RIGHT_%i_TM' % (cand_num)])
-
-            left = CandidatePrimer('LEFT', left_name, left_seq, left_start, left_gc, left_tm, references)
-            right = CandidatePrimer('RIGHT', right_name, right_seq, right_start, right_gc, right_tm, references)
-
-            self.candidate_pairs.append(CandidatePrimerPair(left, right))
+        candidates = []
+        primers = []
+        seen = {}
+        left_name = '%s_%i_%s' % (prefix, region_num, 'LEFT')
+        right_name = '%s_%i_%s' % (prefix, region_num, 'RIGHT')
+
+        for (left_seq, left_pos, left_gc, left_tm,
+             right_seq, right_pos, right_gc, right_tm) in parse_primer3_output(primer3_output, primer3_keys):
+            left_start = int(left_pos + start_limits[0])
+            right_start = int(right_pos + start_limits[0] + 1)
+
+            # Primer3 reuses the same primer across several pairs; share one object so it is only aligned once
+            left_key = ('LEFT', left_seq, left_start)
+            if left_key not in seen:
+                seen[left_key] = CandidatePrimer('LEFT', left_name, left_seq, left_start, left_gc, left_tm)
+                primers.append(seen[left_key])
+            right_key = ('RIGHT', right_seq, right_start)
+            if right_key not in seen:
+                seen[right_key] = CandidatePrimer('RIGHT', right_name, right_seq, right_start, right_gc, right_tm)
+                primers.append(seen[right_key])
+            candidates.append((seen[left_key], seen[right_key]))
+
+        # Align every distinct candidate against every reference in a single pass
+        for primer, alignments in zip(primers, align_primers(primers, ref_seqs, worker_pool)):
+            primer.alignments = alignments
+            primer.sub_total = sum(alignment.score for alignment in alignments)
+
+        self.candidate_pairs = [CandidatePrimerPair(left, right) for left, right in candidates]
         # Select the highest scoring pair with the rightmost position
         self.candidate_pairs.sort(key=lambda x: (x.total, x.right.end), reverse=True)
 
@@ -110,73 +138,174 @@ class Region(object):
 class Alignment(object):
     """An alignment of a primer against a reference."""
 
-    def __init__(self, primer, ref):
-        # Do alignments
+    __slots__ = ('start', 'end', 'length', 'score', 'aln_query', 'aln_ref', 'primer_name', 'ref_id', 'mm_3prime')
+
+    def __init__(self, primer, ref_id, ref_fwd, ref_rc, profile, dp_cache):
+        # Search windows; RIGHT windows are sliced from the precomputed reverse complement
+        primer_seq = primer.seq
+        ref_len = len(ref_fwd)
         if primer.direction == 'LEFT':
             search_start = primer.start - 100 if primer.start > 100 else 0
-            search_end = primer.end + 100 if primer.end + 100 <= len(ref) else len(ref)
-            alns = pairwise2.align.globalms(str(primer.seq), str(ref.seq[search_start:search_end]), 2, -1, -2, -1, penalize_end_gaps=False, one_alignment_only=True)
+            search_end = primer.end + 100 if primer.end + 100 <= ref_len else ref_len
+            window = ref_fwd[search_start:search_end]
         elif primer.direction == 'RIGHT':
             search_start = primer.end - 100 if primer.start > 100 else 0
-            search_end = primer.start + 100 if primer.start + 100 <= len(ref) else len(ref)
-            alns = pairwise2.align.globalms(str(primer.seq), str(ref.seq[search_start:search_end].reverse_complement()), 2, -1, -2, -1, penalize_end_gaps=False, one_alignment_only=True)
-        if alns:
-            aln = alns[0]
-
-            p = re.compile('(-*)([ACGTN][ACGTN\-]*[ACGTN])(-*)')
-            m = list(re.finditer(p, str(aln[0])))[0]
+            search_end = primer.start + 100 if primer.start + 100 <= ref_len else ref_len
+            # Clamp at 0 so a reference shorter than search_start gives an empty window rather than wrapping
+            window = ref_rc[max(ref_len - search_end, 0):max(ref_len - search_start, 0)]
+
+        # An exact match is the best possible alignment, so skip the DP for it
+        pos = window.find(primer_seq)
+        if not window:
+            # A reference that ends before the search window leaves nothing to align against
+            aln_query = None
+        elif pos >= 0:
+            aln_start = pos
+            aln_end = pos + len(primer_seq)
+            aln_query = aln_ref = primer_seq
+            raw_score = MATCH * len(primer_seq)
+        else:
+            # Closely related references often share a window; reuse the DP result from the first one
+            if window not in dp_cache:
+                dp_cache[window] = _align_window(profile, window)
+            aln_start, aln_end, aln_query, aln_ref, raw_score = dp_cache[window]
 
+        if aln_query:
             if primer.direction == 'LEFT':
-                self.start = search_start + m.span(2)[0]
-                self.end = search_start + m.span(2)[1]
+                self.start = search_start + aln_start
+                self.end = search_start + aln_end
                 self.length = self.end - self.start
             else:
-                self.start = search_end - m.span(2)[0]
-                self.end = search_end - m.span(2)[1]
+                self.start = search_end - aln_start
+                self.end = search_end - aln_end
                 self.length = self.start - self.end
 
             # Normalise alignment score by length
-            self.score = aln[2] / self.length
+            self.score = float(raw_score) / self.length
 
             # Get alignment strings
-            self.aln_query = aln[0][m.span(2)[0]:m.span(2)[1]]
-            self.aln_ref = aln[1][m.span(2)[0]:m.span(2)[1]]
-            self.aln_ref_comp = Seq.Seq(str(self.aln_ref)).complement()
-            self.ref_id = ref.id
+            self.aln_query = aln_query
+            self.aln_ref = aln_ref
+            self.primer_name = primer.name
+            self.ref_id = ref_id
             self.mm_3prime = False
 
-            # Make cigar
-            self.cigar = ''
-            for a, b in zip(self.aln_query, self.aln_ref):
-                if a == '-' or b == '-':
-                    self.cigar += ' '
-                    continue
-                if a != b:
-                    self.cigar += '*'
-                    continue
-                else:
-                    self.cigar += '|'
-
-            # Format alignment
-            short_primer = primer.name[:30] if len(primer.name) > 30 else primer.name
-            short_ref = ref.id[:30] if len(ref.id) > 30 else ref.id
-            self.formatted_alignment = "\n{: <30}5\'-{}-3\'\n{: <33}{}\n{: <30}3\'-{}-5\'".format(short_primer, self.aln_query, '', self.cigar, short_ref, self.aln_ref_comp)
-
             # Check 3' mismatches
-            if set([self.aln_query[-1], self.aln_ref_comp[-1]]) in settings.MISMATCHES:
+            if (self.aln_query[-1], self.aln_ref[-1]) in MISMATCHES_3PRIME:
                 self.mm_3prime = True
                 self.score = 0
 
         else:
             self.score = 0
-            self.formatted_alignment = 'None found'
+            self.aln_query = None
+
+    @property
+    def aln_ref_comp(self):
+        return self.aln_ref.translate(COMPLEMENT)
+
+    @property
+    def cigar(self):
+        # Identical strings are compared in one go rather than base by base
+        if self.aln_query == self.aln_ref:
+            return '|' * len(self.aln_query)
+        cigar = []
+        for a, b in zip(self.aln_query, self.aln_ref):
+            if a == '-' or b == '-':
+                cigar.append(' ')
+            elif a != b:
+                cigar.append('*')
+            else:
+                cigar.append('|')
+        return ''.join(cigar)
+
+    @property
+    def formatted_alignment(self):
+        """The alignment laid out for logging; only built when asked for."""
+        if self.aln_query is None:
+            return 'None found'
+        return "\n{: <30}5\'-{}-3\'\n{: <33}{}\n{: <30}3\'-{}-5\'".format(
+            self.primer_name[:30], self.aln_query, '', self.cigar, self.ref_id[:30], self.aln_ref_comp)
+
+
+def _align_window(profile, window):
+    """
+    Align a primer profile against a reference window.
+
+    Returns (aln_start, aln_end, aln_query, aln_ref, raw_score), trimmed to the span covered by the primer.
+    """
+    result = parasail.sg_trace_striped_profile_sat(profile, window, GAP_OPEN, GAP_EXTEND)
+    # Span of the primer within the alignment, excluding leading/trailing gaps
+    traceback = result.traceback
+    aln_start = len(traceback.query) - len(traceback.query.lstrip('-'))
+    aln_end = len(traceback.query.rstrip('-'))
+    return aln_start, aln_end, traceback.query[aln_start:aln_end], traceback.ref[aln_start:aln_end], result.score
+
+
+# Primer3 output keys for each candidate number; MultiplexScheme formats them once for all its regions
+PRIMER3_KEY_FORMATS = ('PRIMER_LEFT_%i_SEQUENCE', 'PRIMER_LEFT_%i', 'PRIMER_LEFT_%i_GC_PERCENT', 'PRIMER_LEFT_%i_TM',
+                       'PRIMER_RIGHT_%i_SEQUENCE', 'PRIMER_RIGHT_%i', 'PRIMER_RIGHT_%i_GC_PERCENT', 'PRIMER_RIGHT_%i_TM')
+
+
+def parse_primer3_output(primer3_output, primer3_keys):
+    """
+    Unpack the candidate pairs Primer3 returned.
+
+    primer3_keys holds the formatted PRIMER3_KEY_FORMATS for each candidate number, and at most that many pairs are
+    read. Yields one tuple per pair, (left_seq, left_pos, left_gc, left_tm, right_seq, right_pos, right_gc, right_tm),
+    with positions relative to the Primer3 template.
+    """
+    num_returned = primer3_output['PRIMER_PAIR_NUM_RETURNED']
+    for (left_seq_key, left_key, left_gc_key, left_tm_key,
+         right_seq_key, right_key, right_gc_key, right_tm_key) in primer3_keys[:num_returned]:
+        yield (str(primer3_output[left_seq_key]),
+               primer3_output[left_key][0],
+               float(primer3_output[left_gc_key]),
+               float(primer3_output[left_tm_key]),
+               str(primer3_output[right_seq_key]),
+               primer3_output[right_key][0],
+               float(primer3_output[right_gc_key]),
+               float(primer3_output[right_tm_key]))
+
+
+def align_primers(primers, ref_seqs, worker_pool=None):
+    """
+    Align each primer against every reference, returning alignments indexed by [primer][reference].
+
+    References are given as (id, sequence, reverse complement) string tuples. If a multiprocessing pool is given as
+    worker_pool, primers are distributed across its workers; the pool must have been created with _init_align_worker
+    for the same references.
+    """
+    if worker_pool:
+        return worker_pool.map(_align_primer_worker, primers)
+    return [_align_primer(primer, ref_seqs) for primer in primers]
+
+
+def _align_primer(primer, ref_seqs):
+    # The query profile depends only on the primer, so build it once and reuse it for every reference
+    profile = parasail.profile_create_sat(primer.seq, MATRIX)
+    dp_cache = {}
+    return [Alignment(primer, ref_id, fwd, rc, profile, dp_cache)
+            for ref_id, fwd, rc in ref_seqs]
+
+
+# References held by each worker process, set once by the pool initializer
+_worker_references = None
+
+
+def _init_align_worker(ref_seqs):
+    global _worker_references
+    _worker_references = ref_seqs
+
+
+def _align_primer_worker(primer):
+    return _align_primer(primer, _worker_references)
 
 
 class MultiplexScheme(object):
     """A complete multiplex primer scheme."""
 
     def __init__(self, references, amplicon_length, min_overlap=20, max_gap=100, window_size=50, search_space=40,
-                 max_candidates=10, step_size=20, prefix='PRIMAL_SCHEME'):
+                 max_candidates=10, step_size=20, prefix='PRIMAL_SCHEME', processes=1, cache_dir=None):
         self.references = references
         self.amplicon_length = amplicon_length
         self.min_overlap = min_overlap
@@ -186,7 +315,22 @@ class MultiplexScheme(object):
         self.max_candidates = max_candidates
         self.step_size = step_size
         self.prefix = prefix
+        self.processes = processes
+        self.cache_dir = cache_dir
         self.regions = []
+        self._worker_pool = None
+
+        # Plain string copies of each reference and its reverse complement, sliced by every alignment
+        self._ref_seqs = [(r.id, str(r.seq), str(r.seq.reverse_complement())) for r in references]
+
+        # Primer3 global settings are the same for every region; work on a copy so settings.outer_params is untouched
+        self._p3_global_args = dict(settings.outer_params)
+        self._p3_global_args['PRIMER_PRODUCT_SIZE_RANGE'] = [
+            [int(self.amplicon_length * 0.9), int(self.amplicon_length * 1.1)]]
+        self._p3_global_args['PRIMER_NUM_RETURN'] = self.max_candidates
+
+        # Primer3 output key names for each candidate number, shared by every region
+        self._p3_output_keys = [tuple(key % i for key in PRIMER3_KEY_FORMATS) for i in range(self.max_candidates)]
 
         self.run()
 
@@ -195,13 +339,26 @@ class MultiplexScheme(object):
         return self.references[0]
 
     def run(self):
+        # Candidate alignments are spread over worker processes, which are given the references once
+        if self.processes > 1:
+            self._worker_pool = multiprocessing.Pool(self.processes, initializer=_init_align_worker, initargs=(self._ref_seqs,))
+        try:
+            self.regions = self._design_regions()
+        finally:
+            if self._worker_pool:
+                self._worker_pool.close()
+                self._worker_pool.join()
+                self._worker_pool = None
+
+    def _design_regions(self):
         regions = []
         region_num = 0
+        ref_len = len(self.primary_reference)
 
         while True:
             region_num += 1
-            prev_pair = regions[-1].candidate_pairs[0] if region_num > 1 else None
-            prev_pair_same_pool = regions[-2].candidate_pairs[0] if region_num > 2 else None
+            prev_pair = regions[-1].top_pair if region_num > 1 else None
+            prev_pair_same_pool = regions[-2].top_pair if region_num > 2 else None
 
             # Left start limit
             if prev_pair_same_pool:
@@ -220,50 +377,52 @@ class MultiplexScheme(object):
             if prev_pair_same_pool and right_start_limit <= left_start_limit:
                 raise ValueError("Amplicon length too short for specified overlap")
 
-            is_last_region = (region_num > 1 and len(self.primary_reference) - prev_pair.right.start < self.amplicon_length)
+            is_last_region = (region_num > 1 and ref_len - prev_pair.right.start < self.amplicon_length)
 
             # Find primers
             try:
                 region = self._find_primers(region_num, left_start_limit, right_start_limit, is_last_region)
                 regions.append(region)
             except NoSuitableException:
-                pass
+                # Retrying would use the same limits, so only the final region may be left undesigned
+                if not is_last_region:
+                    raise
 
             # Handle the end; maximum uncovered genome is one overlap's length
-            if prev_pair and len(self.primary_reference) - prev_pair.right.start < self.amplicon_length:
+            if is_last_region:
                 break
 
-        self.regions = regions
+        return regions
 
     def write_bed(self, path='./'):
         logger.info('Writing BED')
         filepath = os.path.join(path, '{}.bed'.format(self.prefix))
+        lines = []
+        for r in self.regions:
+            lines.append('\t'.join(map(
+                str, [self.primary_reference.id, r.top_pair.left.start, r.top_pair.left.end, r.top_pair.left.name, r.pool])))
+            lines.append('\t'.join(map(str, [self.primary_reference.id, r.top_pair.right.end,
+                                              r.top_pair.right.start, r.top_pair.right.name, r.pool])))
         with open(filepath, 'w') as bedhandle:
-            for r in self.regions:
-                print >>bedhandle, '\t'.join(map(
-                    str, [self.primary_reference.id, r.top_pair.left.start, r.top_pair.left.end, r.top_pair.left.name, r.pool]))
-                print >>bedhandle, '\t'.join(map(str, [self.primary_reference.id, r.top_pair.right.end,
-                                                       r.top_pair.right.start, r.top_pair.right.name, r.pool]))
+            bedhandle.write(''.join(line + '\n' for line in lines))
 
     def write_tsv(self, path='./'):
         logger.info('Writing TSV')
         filepath = os.path.join(path, '{}.tsv'.format(self.prefix))
+        lines = ['\t'.join(['name', 'seq', 'length', '%gc', 'tm (use 65)'])]
+        for r in self.regions:
+            left = r.top_pair.left
+            right = r.top_pair.right
+            lines.append('\t'.join(map(str, [left.name, left.seq, left.length, left.gc, left.tm])))
+            lines.append('\t'.join(map(str, [right.name, right.seq, right.length, right.gc, right.tm])))
         with open(filepath, 'w') as tsvhandle:
-            print >>tsvhandle, '\t'.join(
-                ['name', 'seq', 'length', '%gc', 'tm (use 65)'])
-            for r in self.regions:
-                left = r.top_pair.left
-                right = r.top_pair.right
-                print >>tsvhandle, '\t'.join(
-                    map(str, [left.name, left.seq, left.length, left.gc, left.tm]))
-                print >>tsvhandle, '\t'.join(
-                    map(str, [right.name, right.seq, right.length, right.gc, right.tm]))
+            tsvhandle.write(''.join(line + '\n' for line in lines))
 
     def write_pickle(self, path='./'):
         logger.info('Writing pickles')
         filepath = os.path.join(path, '{}.pickle'.format(self.prefix))
         with open(filepath, 'wb') as pickleobj:
-            pickle.dump(self.regions, pickleobj)
+            pickle.dump(self.regions, pickleobj, pickle.HIGHEST_PROTOCOL)
 
     def write_refs(self, path='./'):
         logger.info('Writing references')
@@ -274,8 +433,10 @@ class MultiplexScheme(object):
     def write_schemadelica_plot(self, path='./'):
         logger.info('Writing plot')
         gd_diagram = GenomeDiagram.Diagram("Primer Scheme", track_size=1)
+        # The scale track has no features, so give it explicit bounds for the diagram's range calculation
         scale_track = GenomeDiagram.Track(
-            name='scale', scale=True, scale_fontsize=10, scale_largetick_interval=1000, height=0.1)
+            name='scale', scale=True, scale_fontsize=10, scale_largetick_interval=1000, height=0.1,
+            start=0, end=len(self.primary_reference))
         gd_diagram.add_track(scale_track, 2)
 
         primer_feature_set_1 = GenomeDiagram.FeatureSet()
@@ -336,18 +497,22 @@ class MultiplexScheme(object):
         primer pairs sorted by an alignment score summed over all references.
         """
         logger.info('Processing region {}'.format(region_num))
-        logger.debug('Region {}: forward primer limits {}:{}'.format(region_num, left_limit, right_limit))
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('Region {}: forward primer limits {}:{}'.format(region_num, left_limit, right_limit))
 
-        # Slice primary reference to speed up Primer3 on long sequences
+        # Slice primary reference to speed up Primer3 on long sequences; the cached string avoids copying the
+        # whole SeqRecord sequence for every region
+        primary_seq = self._ref_seqs[0][1]
         if region_num == 1:
-            chunk_end = min(len(self.primary_reference), 1.1 * (self.amplicon_length + self.max_gap))
+            chunk_end = min(len(primary_seq), 1.1 * (self.amplicon_length + self.max_gap))
         else:
-            chunk_end = min(len(self.primary_reference), right_limit + 1.1 * (self.amplicon_length + self.max_gap))
+            chunk_end = min(len(primary_seq), right_limit + 1.1 * (self.amplicon_length + self.max_gap))
         chunk_end = int(chunk_end)
-        seq = str(self.primary_reference.seq)[left_limit:chunk_end]
+        seq = primary_seq[left_limit:chunk_end]
 
         # Primer3 setup
-        p3_global_args = settings.outer_params
+        p3_global_args = self._p3_global_args
         region_key = 'SEQUENCE_PRIMER_PAIR_OK_REGION_LIST'
 
         # Reset to 0 to prevent invalid region key
@@ -368,33 +533,87 @@ class MultiplexScheme(object):
             'SEQUENCE_TEMPLATE': seq,
             'SEQUENCE_INCLUDED_REGION': [0, len(seq) - 1]
         }
-        p3_global_args['PRIMER_PRODUCT_SIZE_RANGE'] = [
-            [int(self.amplicon_length * 0.9), int(self.amplicon_length * 1.1)]]
-        p3_global_args['PRIMER_NUM_RETURN'] = self.max_candidates
         keep_right = False
+        step = self.step_size
 
         while True:
-            primer3_output = primer3.bindings.designPrimers(p3_seq_args, p3_global_args)
+            primer3_output = self._design_primers(p3_seq_args, p3_global_args)
             num_returned = primer3_output['PRIMER_PAIR_NUM_RETURNED']
             if num_returned:
                 break
 
-            if p3_seq_args[region_key][0] == 0 or keep_right:
+            region = p3_seq_args[region_key]
+            prev_end = region[0] + region[1]
+            if region[0] == 0 or keep_right:
                 step_type = 'right'
-                p3_seq_args[region_key][0] = 0
-                p3_seq_args[region_key][1] += self.step_size
+                region[0] = 0
+                region[1] += step
                 keep_right = True
             else:
                 step_type = 'left'
-                p3_seq_args[region_key][0] -= self.step_size
-                p3_seq_args[region_key][1] += self.step_size
-                if p3_seq_args[region_key][0] < 0:
+                region[0] -= step
+                region[1] += step
+                if region[0] < 0:
+                    # Clamp to the start of the sequence, Primer3 rejects a negative offset
+                    region[1] += region[0]
+                    region[0] = 0
                     keep_right = True
 
-            logger.debug('Region {}: step type {}, range {}:{}, limit {}, keep right={}'.format(region_num, step_type, p3_seq_args[region_key][0] + left_limit, p3_seq_args[region_key][0] + left_limit + p3_seq_args[region_key][1], str(left_limit) if step_type == 'left' else 'none', keep_right))
+            # Double the step after each miss so repeated failures cost O(log n) Primer3 calls
+            step *= 2
+
+            # Trim a step that would run past the end of the template; give up once the region already ended there
+            if region[0] + region[1] > len(seq):
+                if prev_end >= len(seq):
+                    raise NoSuitableException('Region {}: no suitable primers between {} and {}'.format(
+                        region_num, left_limit, left_limit + len(seq)))
+                region[1] = len(seq) - region[0]
 
-            if left_limit + p3_seq_args[region_key][0] + p3_seq_args[region_key][1] > len(self.primary_reference):
-                raise NoSuitableException
+            if debug:
+                logger.debug('Region {}: step type {}, range {}:{}, limit {}, keep right={}'.format(region_num, step_type, region[0] + left_limit, region[0] + left_limit + region[1], str(left_limit) if step_type == 'left' else 'none', keep_right))
 
-        return Region(self.prefix, region_num, self.max_candidates, (left_limit, right_limit), primer3_output,
-                      self.references)
+        return Region(self.prefix, region_num, self._p3_output_keys, (left_limit, right_limit), primer3_output,
+                      self._ref_seqs, self._worker_pool)
+
+    def _design_primers(self, p3_seq_args, p3_global_args):
+        """
+        Run Primer3 on the given arguments.
+
+        If a cache directory is set, the output is stored there keyed by a hash of the arguments, and an
+        identical call in a later run loads it instead of running Primer3 again.
+        """
+        if not self.cache_dir:
+            return primer3.bindings.designPrimers(p3_seq_args, p3_global_args)
+
+        # Include the Primer3 version so upgrading it does not serve results from the old one
+        key = repr((getattr(primer3, '__version__', None),
+                    sorted(p3_seq_args.items()), sorted(p3_global_args.items())))
+        filepath = os.path.join(self.cache_dir, '{}.pickle'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as cacheobj:
+                return pickle.load(cacheobj)
+
+        primer3_output = primer3.bindings.designPrimers(p3_seq_args, p3_global_args)
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            # Another run sharing the cache directory may have just created it
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file and rename it into place, so concurrent runs never load a partial pickle
+        cacheobj = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False)
+        try:
+            with cacheobj:
+                pickle.dump(primer3_output, cacheobj, pickle.HIGHEST_PROTOCOL)
+            try:
+                os.rename(cacheobj.name, filepath)
+            except OSError:
+                # Windows will not rename over an existing file; another run has already stored this result
+                if not os.path.isfile(filepath):
+                    raise
+        finally:
+            # Only left behind if the dump or rename failed
+            if os.path.exists(cacheobj.name):
+                os.remove(cacheobj.name)
+        return primer3_output
@@ -18,21 +18,21 @@ outer_params = {
     'PRIMER_PICK_INTERNAL_OLIGO': 0,
 }
 
-MATCHES = [
-    set(['A', 'T']),
-    set(['C', 'G']),
-    set(['G', 'T']),
-    set(['C', 'T']),
-    set(['T', 'T'])
-],
+MATCHES = frozenset([
+    frozenset(['A', 'T']),
+    frozenset(['C', 'G']),
+    frozenset(['G', 'T']),
+    frozenset(['C', 'T']),
+    frozenset(['T', 'T'])
+])
 
-MISMATCHES = [
-    set(['A', 'A']),
-    set(['A', 'C']),
-    set(['C', 'C']),
-    set(['G', 'A']),
-    set(['G', 'G']),
-]
+MISMATCHES = frozenset([
+    frozenset(['A', 'A']),
+    frozenset(['A', 'C']),
+    frozenset(['C', 'C']),
+    frozenset(['G', 'A']),
+    frozenset(['G', 'G']),
+])
 
 NATIVE_DICT = {
     'NB01': 'AAGAAAGTTGTCGGTGTCTTTGTG',